@@ -0,0 +1,775 @@
+'''
+benchmark.py
+
+Benchmarks for the aggregator. Runs without a RabbitMQ server.
+
+Commandline parameters:
+  -h, --help            show this help message and exit
+  --sizes SIZES         Comma separated list of unit counts. Default 1000,10000,100000
+  --repeat REPEAT       How many times each measurement is repeated. Default 20
+  --batchsize BATCHSIZE
+                        Batch size for the ingest, metrics and e2e benchmarks. Default 500
+  --duration DURATION   Seconds each fleet size runs in the e2e benchmark. Default 10
+  --pollinterval POLLINTERVAL
+                        Poll and results interval of the e2e benchmark. Default 1
+  --engine {threads,single}
+                        Engine of the e2e benchmark. Default threads
+  --storage {dict,columnar,incremental}
+                        Storage mode of the e2e benchmark. Default dict
+  --scattermode {unicast,broadcast,sharded,adaptive}
+                        Scatter mode of the e2e benchmark. Default broadcast
+  --wireformat {json,binary}
+                        Wire format of the e2e benchmark. Default json
+  --latency LATENCY     Mean response latency of the virtual units. Default 0.05
+  --distribution {constant,uniform,exponential,lognormal}
+                        Latency distribution of the virtual units. Default exponential
+  --droprate DROPRATE   Probability that a virtual unit does not respond. Default 0
+  --drift DRIFT         SoC drift of the virtual units in one second. Default 0.01
+  --pollrange POLLRANGE
+                        Shortest and longest poll interval of the adaptive scatter mode.
+                        Default 0.5,10
+  --roundresults        Post the results of the e2e benchmark when a poll round completes
+  --output OUTPUT       File where the e2e results are written. Default e2e.json
+  --compare COMPARE     An earlier e2e results file to compare the results with.
+  --rate RATE           Responses per second in the overload benchmark. Default 100000
+
+Benchmarks:
+  snapshot              Lock hold time and allocation of DataStorage snapshots and the cost
+                        of the first write after a snapshot.
+  ingest                Messages per second stored one by one and in batches.
+  wire                  Decode throughput and message size of the JSON and binary formats.
+  results               Message size and decode time of the full and delta results with and
+                        without compression.
+  groups                Analysis time without and with the groups of the units.
+  metrics               Gatherer throughput with the metrics disabled, enabled and enabled
+                        with the lock metrics.
+  overload              Result posting jitter and waiting responses when the responses come
+                        faster than they are stored, without and with the ingest buffer.
+                        Uses --batchsize as the buffer size and --pollinterval as the results
+                        interval.
+  e2e                   The whole pipeline with a virtual fleet on the in-process broker.
+                        Reports the poll round completion latency, polled units and
+                        ingestion rate, result posting jitter, time from the last
+                        response of a round to its results and memory use for each
+                        fleet size.
+
+Copyright 2017 Janne Valtanen
+'''
+
+import argparse
+import bisect
+import threading
+import time
+import gc
+import json
+import sys
+import os
+import random
+import resource
+
+import aggregator
+import test
+
+class TimedLock:
+    '''
+    A lock wrapper that records how long the lock is held.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.acquired = 0.0
+        self.holds = []
+
+    def acquire(self):
+        self.lock.acquire()
+        self.acquired = time.time()
+
+    def release(self):
+        self.holds.append(time.time() - self.acquired)
+        self.lock.release()
+
+def median(values):
+    '''
+    The median of a list of values.
+    '''
+
+    values = sorted(values)
+    return values[len(values)/2]
+
+def percentile(values, p):
+    '''
+    The p:th percentile of a list of values. None if the list is empty.
+    '''
+
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values)*p/100.0))]
+
+def rss():
+    '''
+    The resident set size of the process.
+
+    Returns: The size in megabytes.
+    '''
+
+    # The current size from /proc. Elsewhere the peak size is the best there is.
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1])*resource.getpagesize()/1048576.0
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
+class NullOutput:
+    '''
+    A file like object that throws away everything written to it.
+    '''
+
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+class RoundTimer:
+    '''
+    A wrapper for a data storage that measures when the poll rounds start and when the
+    last response of each round is stored. A new round starts with the first query after
+    half a poll interval without queries. The times when the analyses end are kept too.
+
+    Parameters:
+    - datastorage: The data storage to wrap.
+    - pollinterval: The poll interval in seconds.
+    '''
+
+    def __init__(self, datastorage, pollinterval):
+        self.datastorage = datastorage
+        self.pollinterval = pollinterval
+        self.round_start = None
+        self.ends = []
+        self.last_query = 0.0
+        self.last_response = None
+        self.latencies = []
+        self.queries = 0
+        self.responses = 0
+        self.analyzed = []
+
+    def __getattr__(self, name):
+        return getattr(self.datastorage, name)
+
+    def start_round(self):
+        # Close the previous round with the time of its last response.
+        now = time.time()
+        if now - self.last_query > self.pollinterval/2.0:
+            if self.round_start is not None and self.last_response is not None:
+                self.latencies.append(self.last_response - self.round_start)
+                self.ends.append(self.last_response)
+            self.round_start = now
+            self.last_response = None
+        self.last_query = now
+
+    def query_started(self, unitid):
+        self.start_round()
+        self.queries += 1
+        self.datastorage.query_started(unitid)
+
+    def queries_started(self, unitids):
+        self.start_round()
+        self.queries += len(unitids)
+        self.datastorage.queries_started(unitids)
+
+    def put_data(self, insert):
+        self.datastorage.put_data(insert)
+        self.responses += 1
+        self.last_response = time.time()
+
+    def put_many(self, inserts):
+        self.datastorage.put_many(inserts)
+        self.responses += len(inserts)
+        self.last_response = time.time()
+
+    def analyze(self, current_time, unit_timeout, minimumsoc, maximumsoc):
+        totals = self.datastorage.analyze(current_time, unit_timeout, minimumsoc, maximumsoc)
+        self.analyzed.append(time.time())
+        return totals
+
+def storage_classes():
+    '''
+    The storage classes to benchmark.
+
+    Returns: A list of (name, factory) tuples.
+    '''
+
+    classes = [('dict', aggregator.DataStorage),
+               ('incremental', lambda: aggregator.IncrementalDataStorage(0.1, 0.9))]
+    if aggregator.numpy is not None:
+        classes.append(('columnar', aggregator.ColumnarDataStorage))
+    return classes
+
+def fill_storage(storage, size):
+    '''
+    Fill the storage with one round of queries and responses.
+
+    Returns: The list of unit IDs.
+    '''
+
+    unitids = ['Unit%d' % i for i in xrange(size)]
+    for unitid in unitids:
+        storage.query_started(unitid)
+    for i, unitid in enumerate(unitids):
+        storage.put_data({'UnitId': unitid, 'Active': True, 'SoC': (i % 100)/100.0,
+                          'TotalCapacity': 1000})
+    return unitids
+
+def snapshot(storage):
+    '''
+    Take a snapshot with the native snapshot method of the storage.
+    '''
+
+    if isinstance(storage, aggregator.ColumnarDataStorage):
+        return storage.get_columns()
+    return storage.get_all_data()
+
+def benchmark_snapshot(sizes, repeat):
+    '''
+    Measure the lock hold time and the number of allocated objects per snapshot and the
+    time of the first write after a snapshot. The writes do not copy the data so the first
+    write costs at most as much as a write after the caches have been evicted, at every fleet
+    size. The last row of every storage is the largest ratio of the two.
+    '''
+
+    print "%-12s %8s %16s %14s %18s %18s" % ('storage', 'units', 'lock hold (us)', 'objects/snap',
+                                             'first write (us)', 'cold write (us)')
+    for name, factory in storage_classes():
+        ratios = []
+        for size in sizes:
+            storage = factory()
+            unitids = fill_storage(storage, size)
+            storage.lock = TimedLock()
+
+            holds = []
+            objects = []
+            writes = []
+            colds = []
+            for i in xrange(repeat):
+                # Count the objects kept alive by the snapshot.
+                gc.collect()
+                gc.disable()
+                before = len(gc.get_objects())
+                data = snapshot(storage)
+                objects.append(len(gc.get_objects()) - before)
+                gc.enable()
+                del data
+
+                # Walking the objects above evicts the caches so the lock and the first
+                # write are measured with another snapshot.
+                storage.put_data({'UnitId': unitids[(i + 1) % size], 'Active': True, 'SoC': 0.5,
+                                  'TotalCapacity': 1000})
+                del storage.lock.holds[:]
+                data = snapshot(storage)
+                holds.append(storage.lock.holds[0])
+                start = time.time()
+                storage.put_data({'UnitId': unitids[i % size], 'Active': True, 'SoC': 0.5,
+                                  'TotalCapacity': 1000})
+                writes.append(time.time() - start)
+                del data
+
+                # The same write after evicting the caches.
+                evict = bytearray(16 << 20)
+                del evict
+                start = time.time()
+                storage.put_data({'UnitId': unitids[(i + 2) % size], 'Active': True, 'SoC': 0.5,
+                                  'TotalCapacity': 1000})
+                colds.append(time.time() - start)
+
+            ratios.append(median(writes)/median(colds))
+            print "%-12s %8d %16.1f %14d %18.1f %18.1f" % (name, size, median(holds)*1e6, median(objects),
+                                                           median(writes)*1e6, median(colds)*1e6)
+        print "%-12s %8s first write at most x%.1f of the cold write" % (name, 'all', max(ratios))
+
+def benchmark_ingest(sizes, repeat, batchsize):
+    '''
+    Measure how many status messages per second can be decoded and stored one by one
+    like the Gatherer does by default and in batches like in the batched mode.
+    '''
+
+    print "%-12s %8s %14s %14s %8s" % ('storage', 'units', 'single (msg/s)', 'batched (msg/s)', 'gain')
+    for name, factory in storage_classes():
+        for size in sizes:
+            storage = factory()
+            unitids = fill_storage(storage, size)
+            bodies = [json.dumps({'UnitId': unitid, 'Active': True, 'SoC': 0.5, 'TotalCapacity': 1000})
+                      for unitid in unitids]
+
+            single = []
+            batched = []
+            for i in xrange(repeat):
+                start = time.time()
+                for body in bodies:
+                    storage.put_data(json.loads(body))
+                single.append(time.time() - start)
+
+                start = time.time()
+                for first in xrange(0, size, batchsize):
+                    storage.put_many(aggregator.decode_statuses(bodies[first:first+batchsize]))
+                batched.append(time.time() - start)
+
+            single_rate = size/median(single)
+            batched_rate = size/median(batched)
+            print "%-12s %8d %14.0f %14.0f %7.1fx" % (name, size, single_rate, batched_rate,
+                                                     batched_rate/single_rate)
+
+def benchmark_wire(sizes, repeat):
+    '''
+    Measure the decode throughput and the bytes on the wire of the status responses in
+    JSON and in the binary format with and without the unit index.
+    '''
+
+    print "%-14s %8s %16s %14s" % ('format', 'units', 'decode (msg/s)', 'bytes/msg')
+    for size in sizes:
+        unitids = ['Unit%d' % i for i in xrange(size)]
+        unitindex = aggregator.UnitIndex(unitids)
+        formats = [('json', [json.dumps({'UnitId': unitid, 'Active': True, 'SoC': 0.5, 'TotalCapacity': 1000})
+                             for unitid in unitids], aggregator.JSON_CONTENT_TYPE),
+                   ('binary', [aggregator.encode_status(unitid, i, True, 0.5, 1000)
+                               for i, unitid in enumerate(unitids)], aggregator.STATUS_CONTENT_TYPE),
+                   ('binary no idx', [aggregator.encode_status(unitid, None, True, 0.5, 1000)
+                                      for unitid in unitids], aggregator.STATUS_CONTENT_TYPE)]
+
+        for name, bodies, content_type in formats:
+            content_types = [content_type]*size
+            times = []
+            for i in xrange(repeat):
+                start = time.time()
+                aggregator.decode_statuses(bodies, content_types, unitindex)
+                times.append(time.time() - start)
+            print "%-14s %8d %16.0f %14.1f" % (name, size, size/median(times),
+                                               sum(len(body) for body in bodies)/float(size))
+
+def benchmark_groups(sizes, repeat):
+    '''
+    Measure the analysis time without groups and with three dimensions of groups: a few
+    regions, a site for every hundred units and three unit classes, and with a site for
+    every unit.
+    '''
+
+    print "%-12s %8s %14s %16s %18s" % ('storage', 'units', 'plain (ms)', 'grouped (ms)', 'site/unit (ms)')
+    for name, factory in storage_classes():
+        for size in sizes:
+            unitids = ['Unit%d' % i for i in xrange(size)]
+            dimensions = ['Region', 'Site', 'Class']
+            layouts = [None,
+                       dict((unitid, {'Region': 'R%d' % (i % 5), 'Site': 'S%d' % (i/100), 'Class': 'C%d' % (i % 3)})
+                            for i, unitid in enumerate(unitids)),
+                       dict((unitid, {'Region': 'R%d' % (i % 5), 'Site': 'S%d' % i, 'Class': 'C%d' % (i % 3)})
+                            for i, unitid in enumerate(unitids))]
+            times = []
+            for tags in layouts:
+                storage = factory()
+                if tags is not None:
+                    storage = aggregator.make_storage(name, 0.1, 0.9, groups=aggregator.UnitGroups(dimensions, tags))
+                fill_storage(storage, size)
+                elapsed = []
+                for i in xrange(repeat):
+                    start = time.time()
+                    storage.analyze(time.time(), 60.0, 0.1, 0.9)
+                    elapsed.append(time.time() - start)
+                times.append(median(elapsed)*1000.0)
+            print "%-12s %8d %14.2f %16.2f %18.2f" % (name, size, times[0], times[1], times[2])
+
+def benchmark_results(sizes, repeat):
+    '''
+    Measure the bytes on the wire and the decode time of a results message in the full
+    and delta formats with and without compression. A tenth of the units is out of bounds
+    and a hundredth of them changes between the messages.
+    '''
+
+    print "%-14s %8s %14s %16s" % ('format', 'units', 'bytes/msg', 'decode (us/msg)')
+    rand = random.Random(0)
+    for size in sizes:
+        # The results of consecutive intervals.
+        unitids = ['Unit%d' % i for i in xrange(size)]
+        oob = set(rand.sample(unitids, size/10))
+        messages = []
+        for i in xrange(repeat):
+            for unitid in rand.sample(unitids, max(1, size/100)):
+                if unitid in oob:
+                    oob.remove(unitid)
+                else:
+                    oob.add(unitid)
+            messages.append({'AverageSoC': rand.random(), 'RemainingCapacity': rand.random()*size*1000,
+                             'NumberOfActiveUnits': size, 'NumberOfUnits': size,
+                             'UnitsOutOfBoundaries': sorted(oob)})
+
+        for name, delta, threshold in [('full', False, 0), ('full+zlib', False, 1), ('delta', True, 0),
+                                       ('delta+zlib', True, 1)]:
+            encoder = aggregator.ResultEncoder(delta, repeat, threshold)
+            encoded = [encoder.encode(results) for results in messages]
+            decoder = aggregator.ResultDecoder()
+            start = time.time()
+            for body, properties in encoded:
+                decoder.decode(body, properties)
+            elapsed = time.time() - start
+            print "%-14s %8d %14.0f %16.1f" % (name, size, sum(len(body) for body, properties in encoded)/
+                                               float(repeat), elapsed*1e6/repeat)
+
+def benchmark_metrics(sizes, repeat, batchsize):
+    '''
+    Measure the overhead of the metrics on the hot path. A round of status responses goes
+    through the Gatherer from the in-process broker to the storage one by one and in batches.
+    The rounds with the metrics disabled, enabled and enabled with the lock metrics take turns
+    so that all see the same conditions.
+    '''
+
+    print "%-12s %8s %10s %14s %14s %10s %14s %10s" % ('storage', 'units', 'mode', 'off (msg/s)', 'on (msg/s)',
+                                                     'overhead', 'locks (msg/s)', 'overhead')
+    enabled = aggregator.metrics
+    disabled = aggregator.Metrics(enabled=False)
+    locked = aggregator.Metrics(lock_metrics=True)
+    stdout = sys.stdout
+    try:
+        for name, factory in storage_classes():
+            for size in sizes:
+                unitids = ['Unit%d' % i for i in xrange(size)]
+                bodies = [json.dumps({'UnitId': unitid, 'Active': True, 'SoC': 0.5, 'TotalCapacity': 1000})
+                          for unitid in unitids]
+                for mode, chunk in [('single', 1), ('batched', batchsize)]:
+                    # A storage and a gatherer for both. The storage takes its lock from the metrics.
+                    setups = []
+                    sys.stdout = NullOutput()
+                    for metrics in [disabled, enabled, locked]:
+                        aggregator.metrics = metrics
+                        storage = factory()
+                        connection = aggregator.open_connection(aggregator.INPROCESS_SCHEME+'metrics%d' %
+                                                                len(setups))
+                        gatherer = aggregator.Gatherer(None, storage, 0, chunk, 1.0, connection=connection)
+                        setups.append((metrics, storage, connection, gatherer, connection.channel(), []))
+                    sys.stdout = stdout
+
+                    for i in xrange(repeat):
+                        for metrics, storage, connection, gatherer, channel, times in setups:
+                            aggregator.metrics = metrics
+                            storage.queries_started(unitids)
+                            for body in bodies:
+                                channel.basic_publish(exchange='', routing_key='states', body=body)
+                            # The responses are waiting for the gatherer so this runs them all.
+                            start = time.time()
+                            connection.process_data_events()
+                            gatherer.flush()
+                            times.append(time.time() - start)
+
+                    off, on, locks = [size/median(setup[5]) for setup in setups]
+                    for setup in setups:
+                        setup[2].close()
+                    print "%-12s %8d %10s %14.0f %14.0f %9.1f%% %14.0f %9.1f%%" % (name, size, mode, off, on,
+                                                                                 (off/on - 1)*100.0, locks,
+                                                                                 (off/locks - 1)*100.0)
+    finally:
+        aggregator.metrics = enabled
+        sys.stdout = stdout
+
+def run_overload(size, args, buffersize, shedpolicy, maxqueue):
+    '''
+    Store a storm of responses of the given number of units while the results are posted.
+
+    Returns: A dictionary of the measured values.
+    '''
+
+    hostname = aggregator.INPROCESS_SCHEME+'overload%d%s%s' % (size, buffersize, shedpolicy)
+    interval = float(args.pollinterval)
+    rate = float(args.rate)
+    duration = float(args.duration)
+    unitids = ['Unit%d' % i for i in xrange(size)]
+    bodies = [json.dumps({'UnitId': unitid, 'Active': True, 'SoC': 0.5, 'TotalCapacity': 1000})
+              for unitid in unitids]
+
+    # The aggregator without the scatterer. Every unit is queried once so the responses are stored.
+    # The posting jitter is measured from the ends of the analyses because the results would
+    # wait for this thread to receive them.
+    storage = RoundTimer(aggregator.make_storage(args.storage, 0.1, 0.9), interval)
+    storage.queries_started(unitids)
+    scheduler = aggregator.Scheduler()
+    gatherer = aggregator.Gatherer(hostname, storage, 0, int(args.batchsize), 0.05,
+                                   buffer=aggregator.make_ingest_buffer(buffersize, shedpolicy), maxqueue=maxqueue)
+    threads = [gatherer, aggregator.AnalyzerPoster(hostname, storage, interval, duration*2, 0.1, 0.9, scheduler),
+               scheduler]
+    states = aggregator.InProcessBroker.get(hostname[len(aggregator.INPROCESS_SCHEME):]).queues['states']
+
+    # Publish the responses of the units in turns at the rate. The waiting responses are the
+    # ones on the server and the ones delivered to the gatherer but not handled yet.
+    publisher = aggregator.open_connection(hostname).channel()
+    start = time.time()
+    end = start + duration
+    sent = 0
+    waiting = 0
+    while True:
+        now = time.time()
+        if now >= end:
+            break
+        due = int((now - start)*rate)
+        while sent < due:
+            publisher.basic_publish(exchange='', routing_key='states', body=bodies[sent % size])
+            sent += 1
+        waiting = max(waiting, len(states.messages) + len(gatherer.connection.deliveries))
+        time.sleep(0.005)
+
+    for thread in threads:
+        thread.kill()
+    for thread in threads:
+        thread.join(5)
+
+    posted = storage.analyzed
+    jitter = [abs(b - a - interval) for a, b in zip(posted, posted[1:])]
+    return {'sent_s': sent/duration,
+            'stored_s': storage.responses/duration,
+            'jitter_p50_ms': percentile(jitter, 50)*1000.0 if jitter else None,
+            'jitter_max_ms': max(jitter)*1000.0 if jitter else None,
+            'waiting_max': waiting,
+            'coalesced': aggregator.metrics.coalesced.value,
+            'shed': aggregator.metrics.shed.value,
+            'dropped': states.dropped}
+
+def benchmark_overload(sizes, args):
+    '''
+    Measure the posting jitter and the waiting responses when the responses come faster
+    than they are stored, without and with the ingest buffer and its shedding policies.
+    With the buffer the queue on the server holds at most one response per unit.
+    '''
+
+    buffersize = int(args.batchsize)
+    setups = [('batched', 0, 'flush')] + [('buffer '+policy, buffersize, policy)
+                                          for policy in aggregator.IngestBuffer.policies]
+    print "%-20s %8s %10s %10s %10s %10s %12s %10s %10s %10s" % (
+        'mode', 'units', 'sent/s', 'stored/s', 'jitter p50', 'jitter max', 'max waiting', 'coalesced', 'shed',
+        'dropped')
+    enabled = aggregator.metrics
+    stdout = sys.stdout
+    try:
+        for size in sizes:
+            for name, buffersize, shedpolicy in setups:
+                maxqueue = size if buffersize else 0
+                aggregator.metrics = aggregator.Metrics()
+                sys.stdout = NullOutput()
+                try:
+                    row = run_overload(size, args, buffersize, shedpolicy, maxqueue)
+                finally:
+                    sys.stdout = stdout
+                print "%-20s %8d %10.0f %10.0f %10s %10s %12d %10d %10d %10d" % (
+                    name, size, row['sent_s'], row['stored_s'], format_value(row['jitter_p50_ms']),
+                    format_value(row['jitter_max_ms']), row['waiting_max'], row['coalesced'], row['shed'],
+                    row['dropped'])
+    finally:
+        aggregator.metrics = enabled
+        sys.stdout = stdout
+
+def run_e2e(size, args):
+    '''
+    Run the whole pipeline with a virtual fleet of the given size on the in-process broker.
+
+    Returns: A dictionary of the measured values.
+    '''
+
+    hostname = aggregator.INPROCESS_SCHEME+'e2e%d' % size
+    pollinterval = float(args.pollinterval)
+    batchsize = int(args.batchsize)
+    shards = 16
+
+    # The fleet is set up first so the memory it takes can be told apart.
+    rand = random.Random(size)
+    units = [test.VirtualUnit('Unit%d' % i, True, rand.uniform(0.1, 0.9), 1000) for i in xrange(size)]
+    unitids = [unit.unitid for unit in units]
+    fleet = test.VirtualFleet(hostname, units, shards, float(args.latency), args.distribution,
+                              float(args.droprate), float(args.drift), seed=size)
+    rss_before = rss()
+
+    # Listen to the results to measure the posting jitter.
+    connection = aggregator.open_connection(hostname)
+    channel = connection.channel()
+    channel.exchange_declare(exchange='result', type='fanout')
+    queue_name = channel.queue_declare(exclusive=True).method.queue
+    channel.queue_bind(exchange='result', queue=queue_name)
+    posted = []
+    channel.basic_consume(lambda ch, method, properties, body: posted.append(time.time()),
+                          queue=queue_name, no_ack=True)
+
+    # Set up the aggregator.
+    storage = RoundTimer(aggregator.make_storage(args.storage, 0.1, 0.9), pollinterval)
+    pollrange = tuple(float(interval) for interval in args.pollrange.split(','))
+    if args.engine == 'single':
+        threads = [aggregator.Engine(hostname, storage, unitids, pollinterval, args.scattermode, shards, 0,
+                                     batchsize, 0.05, pollinterval, 3*pollinterval, 0.1, 0.9, args.wireformat,
+                                     pollrange=pollrange, round_results=args.roundresults)]
+    else:
+        scheduler = aggregator.Scheduler()
+        unitindex = aggregator.make_unitindex(args.wireformat, unitids)
+        adaptive = aggregator.make_adaptive(args.scattermode, unitids, pollinterval, pollrange, 0.1, 0.9)
+        rounds = None
+        if args.roundresults:
+            rounds = aggregator.RoundTracker(scheduler, 3*pollinterval)
+        threads = [aggregator.Scatterer(hostname, unitids, pollinterval, storage, scheduler, args.scattermode,
+                                        shards, unitindex=unitindex, adaptive=adaptive, rounds=rounds),
+                   aggregator.Gatherer(hostname, storage, 0, batchsize, 0.05, unitindex=unitindex,
+                                       rounds=rounds),
+                   aggregator.AnalyzerPoster(hostname, storage, pollinterval, 3*pollinterval, 0.1, 0.9,
+                                             scheduler, rounds=rounds),
+                   scheduler]
+
+    # Run for the duration.
+    start = time.time()
+    end = start + float(args.duration)
+    while time.time() < end:
+        connection.process_data_events(time_limit=end - time.time())
+    elapsed = time.time() - start
+    rss_after = rss()
+
+    for thread in threads + [fleet]:
+        thread.kill()
+    for thread in threads + [fleet]:
+        thread.join(5)
+    connection.close()
+
+    # The posting jitter is how far the intervals are from the results interval.
+    jitter = [abs(b - a - pollinterval) for a, b in zip(posted, posted[1:])]
+
+    # The result lag is how long after the last response of a round its results were posted.
+    lag = []
+    for end in storage.ends:
+        index = bisect.bisect_left(posted, end)
+        if index < len(posted):
+            lag.append(posted[index] - end)
+    return {'units': size,
+            'rounds': len(storage.latencies),
+            'round_p50_ms': percentile(storage.latencies, 50)*1000.0 if storage.latencies else None,
+            'round_p99_ms': percentile(storage.latencies, 99)*1000.0 if storage.latencies else None,
+            'polls_s': storage.queries/elapsed,
+            'ingest_msg_s': storage.responses/elapsed,
+            'jitter_p50_ms': percentile(jitter, 50)*1000.0 if jitter else None,
+            'jitter_max_ms': max(jitter)*1000.0 if jitter else None,
+            'result_p50_ms': percentile(lag, 50)*1000.0 if lag else None,
+            'rss_mb': rss_after,
+            'rss_aggregator_mb': rss_after - rss_before,
+            'dropped': fleet.dropped}
+
+def benchmark_e2e(sizes, args):
+    '''
+    Run the pipeline for every fleet size, write the results to the output file and
+    compare them with an earlier results file if one is given.
+    '''
+
+    # The keys of the measured values and the column titles.
+    columns = [('round_p50_ms', 'round p50 ms'), ('round_p99_ms', 'round p99 ms'),
+               ('polls_s', 'polls/s'), ('ingest_msg_s', 'ingest msg/s'), ('jitter_p50_ms', 'jitter p50 ms'),
+               ('jitter_max_ms', 'jitter max ms'), ('result_p50_ms', 'result p50 ms'), ('rss_mb', 'RSS MB'), ('rss_aggregator_mb', 'agg. RSS MB')]
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as compare:
+            previous = dict((row['units'], row) for row in json.load(compare)['results'])
+
+    results = []
+    for size in sizes:
+        # The aggregator and the fleet print a lot. Only the results are shown.
+        stdout = sys.stdout
+        sys.stdout = NullOutput()
+        try:
+            results.append(run_e2e(size, args))
+        finally:
+            sys.stdout = stdout
+
+    print "%8s" % 'units' + ''.join("%15s" % title for key, title in columns)
+    for row in results:
+        print "%8d" % row['units'] + ''.join("%15s" % format_value(row[key]) for key, title in columns)
+        if row['units'] in previous:
+            old = previous[row['units']]
+            print "%8s" % 'change' + ''.join("%15s" % format_change(old.get(key), row[key])
+                                             for key, title in columns)
+
+    # Write the results with the parameters so runs can be compared.
+    parameters = dict((key, getattr(args, key)) for key in ['duration', 'pollinterval', 'engine', 'storage',
+                                                             'scattermode', 'wireformat', 'batchsize', 'latency',
+                                                             'distribution', 'droprate', 'drift', 'pollrange',
+                                                             'roundresults'])
+    with open(args.output, 'w') as output:
+        json.dump({'time': time.time(), 'parameters': parameters, 'results': results}, output, indent=2)
+    print "Results written to "+args.output
+
+def format_value(value):
+    '''
+    Format a measured value for the e2e table.
+    '''
+
+    if value is None:
+        return '-'
+    return "%.1f" % value
+
+def format_change(old, new):
+    '''
+    Format the relative change of a measured value for the e2e table.
+    '''
+
+    if not old or new is None:
+        return '-'
+    return "%+.1f%%" % ((new - old)*100.0/old)
+
+if __name__ == '__main__':
+    # Set up the arguments.
+    parser = argparse.ArgumentParser(description='Benchmarks for the aggregator')
+    parser.add_argument('benchmark', choices=['snapshot', 'ingest', 'wire', 'results', 'groups', 'metrics',
+                                                       'overload', 'e2e'],
+                        help='The benchmark to run')
+    parser.add_argument('--sizes', help='Comma separated list of unit counts. Default 1000,10000,100000',
+                        default='1000,10000,100000')
+    parser.add_argument('--repeat', help='How many times each measurement is repeated. Default 20',
+                        default='20')
+    parser.add_argument('--batchsize', help='Batch size for the ingest, metrics and e2e benchmarks. Default 500',
+                        default='500')
+    parser.add_argument('--duration', help='Seconds each fleet size runs in the e2e benchmark. Default 10',
+                        default='10')
+    parser.add_argument('--pollinterval', help='Poll and results interval of the e2e benchmark. Default 1',
+                        default='1')
+    parser.add_argument('--engine', help='Engine of the e2e benchmark. Default threads',
+                        choices=['threads', 'single'], default='threads')
+    parser.add_argument('--storage', help='Storage mode of the e2e benchmark. Default dict',
+                        choices=['dict', 'columnar', 'incremental'], default='dict')
+    parser.add_argument('--scattermode', help='Scatter mode of the e2e benchmark. Default broadcast',
+                        choices=['unicast', 'broadcast', 'sharded', 'adaptive'], default='broadcast')
+    parser.add_argument('--wireformat', help='Wire format of the e2e benchmark. Default json',
+                        choices=['json', 'binary'], default='json')
+    parser.add_argument('--latency', help='Mean response latency of the virtual units. Default 0.05',
+                        default='0.05')
+    parser.add_argument('--distribution', help='Latency distribution of the virtual units. Default exponential',
+                        choices=['constant', 'uniform', 'exponential', 'lognormal'], default='exponential')
+    parser.add_argument('--droprate', help='Probability that a virtual unit does not respond. Default 0',
+                        default='0')
+    parser.add_argument('--drift', help='SoC drift of the virtual units in one second. Default 0.01',
+                        default='0.01')
+    parser.add_argument('--pollrange', help='Shortest and longest poll interval of the adaptive scatter mode. '
+                        'Default 0.5,10', default='0.5,10')
+    parser.add_argument('--roundresults', help='Post the results of the e2e benchmark when a poll round completes',
+                        action='store_true')
+    parser.add_argument('--output', help='File where the e2e results are written. Default e2e.json',
+                        default='e2e.json')
+    parser.add_argument('--compare', help='An earlier e2e results file to compare the results with.')
+    parser.add_argument('--rate', help='Responses per second in the overload benchmark. Default 100000',
+                        default='100000')
+
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    repeat = int(args.repeat)
+
+    if args.benchmark == 'snapshot':
+        benchmark_snapshot(sizes, repeat)
+    elif args.benchmark == 'ingest':
+        benchmark_ingest(sizes, repeat, int(args.batchsize))
+    elif args.benchmark == 'wire':
+        benchmark_wire(sizes, repeat)
+    elif args.benchmark == 'results':
+        benchmark_results(sizes, repeat)
+    elif args.benchmark == 'groups':
+        benchmark_groups(sizes, repeat)
+    elif args.benchmark == 'metrics':
+        benchmark_metrics(sizes, repeat, int(args.batchsize))
+    elif args.benchmark == 'overload':
+        benchmark_overload(sizes, args)
+    elif args.benchmark == 'e2e':
+        benchmark_e2e(sizes, args)
@@ -0,0 +1,269 @@
+'''
+replay.py
+
+Replays traffic recorded with the [Capture] section of aggregator.ini through a data
+storage and the analysis without a RabbitMQ server. The recorded poll rounds mark the
+queries, the recorded responses are decoded and stored like the Gatherer does and the
+results are analyzed and encoded every results interval of the capture. Reports the
+throughput and the time spent in every stage.
+
+At speed 1 the traffic is replayed at the recorded pace. Speed 0 replays it as fast as
+possible. Then the units do not time out like they did when the traffic was recorded
+because the replay takes less time than the unit timeout.
+
+Commandline parameters:
+  -h, --help            show this help message and exit
+  --config CONFIG       The aggregator configuration file for the SoC limits, the results
+                        interval, the unit timeout and the storage mode. Default aggregator.ini
+  --speed SPEED         Replay speed relative to the recorded pace. 0 is as fast as possible.
+                        Default 0
+  --storage {dict,columnar,incremental}
+                        Storage mode. Default from the configuration file
+  --batchsize BATCHSIZE
+                        Responses stored at once. 1 stores them one by one. Default 500
+  --output OUTPUT       File where the results are written. Default replay.json
+  --compare COMPARE     An earlier results file to compare the results with.
+
+Copyright 2017 Janne Valtanen
+'''
+
+import argparse
+import ConfigParser
+import json
+import time
+
+import aggregator
+from benchmark import format_value, format_change
+
+# The stages of the pipeline in the order they are reported.
+STAGES = [('scatter', 'Queries and removed units'),
+          ('decode', 'Decoding the responses'),
+          ('store', 'Storing the responses'),
+          ('analyze', 'Analyzing the storage'),
+          ('results', 'Making the results')]
+
+class Replay:
+    '''
+    The Replay class that feeds the records of a capture to a data storage and times
+    every stage.
+
+    Parameters:
+    - datastorage: The data storage.
+    - batchsize: Responses stored at once. 1 stores them one by one.
+    - results_interval: How often the results are analyzed in seconds of the capture.
+    - unit_timeout: Timeout value when units are considered inactive. In seconds.
+    - minimumsoc: Minimum SoC. Values below this are out of bounds.
+    - maximumsoc: Maximum SoC. Values above this are out of bounds.
+    '''
+
+    def __init__(self, datastorage, batchsize, results_interval, unit_timeout, minimumsoc, maximumsoc):
+        self.datastorage = datastorage
+        self.batchsize = batchsize
+        self.results_interval = results_interval
+        self.unit_timeout = unit_timeout
+        self.minimumsoc = minimumsoc
+        self.maximumsoc = maximumsoc
+
+        # The total seconds and the number of calls of every stage.
+        self.timings = dict((stage, [0.0, 0]) for stage, title in STAGES)
+        self.unitindex = aggregator.UnitIndex()
+        self.batch = []
+        self.content_types = []
+        self.responses = 0
+        self.rounds = 0
+        self.results = None
+
+    def timed(self, stage, function, *args):
+        '''
+        Call a function and add its duration to a stage.
+
+        Returns: The return value of the function.
+        '''
+
+        start = time.time()
+        value = function(*args)
+        timing = self.timings[stage]
+        timing[0] += time.time() - start
+        timing[1] += 1
+        return value
+
+    def run(self, records, speed=0.0):
+        '''
+        Replay the records.
+
+        Parameters:
+        - records: The records from aggregator.read_capture().
+        - speed: Replay speed relative to the recorded pace. 0 is as fast as possible.
+
+        Returns: The wall clock and capture seconds of the replay.
+        '''
+
+        start = time.time()
+        first = None
+        recorded = None
+        next_results = None
+        for kind, recorded, content in records:
+            # The index records are written when the capture log writes, not when the
+            # units were indexed, so their time is not used.
+            if kind == 'I':
+                self.index(*content)
+                continue
+            if first is None:
+                first = recorded
+                next_results = first + self.results_interval
+
+            # Wait until the time of the record. The responses stored so far are not kept
+            # waiting for the batch to fill.
+            if speed > 0:
+                delay = (recorded - first)/speed - (time.time() - start)
+                if delay > 0:
+                    self.flush()
+                    time.sleep(delay)
+
+            while recorded >= next_results:
+                self.post()
+                next_results += self.results_interval
+
+            if kind == 'S':
+                self.response(*content)
+            elif kind == 'Q':
+                self.flush()
+                self.rounds += 1
+                self.timed('scatter', self.datastorage.queries_started, content[1])
+            elif kind == 'R':
+                self.flush()
+                self.timed('scatter', self.datastorage.remove_units, content)
+
+        # The results of the rest of the capture.
+        if first is not None:
+            self.post()
+        else:
+            first = recorded = 0.0
+        return time.time() - start, recorded - first
+
+    def index(self, first_index, unitids):
+        '''
+        Add the unit IDs of an index record. A restarted aggregator starts from index 0.
+        '''
+
+        if first_index < len(self.unitindex.unitids):
+            self.unitindex = aggregator.UnitIndex(self.unitindex.unitids[:first_index])
+        for unitid in unitids:
+            self.unitindex.intern(unitid)
+
+    def response(self, binary, correlation_id, body):
+        '''
+        Store a response like the Gatherer does.
+        '''
+
+        self.responses += 1
+        content_type = aggregator.STATUS_CONTENT_TYPE if binary else 'application/json'
+        if self.batchsize > 1:
+            self.batch.append(body)
+            self.content_types.append(content_type)
+            if len(self.batch) >= self.batchsize:
+                self.flush()
+            return
+
+        try:
+            if binary:
+                data = self.timed('decode', aggregator.decode_status, body, self.unitindex)
+            else:
+                data = self.timed('decode', json.loads, body)
+        except Exception as e:
+            print "Invalid data. Skipping. Error: "+str(e)
+            return
+        self.timed('store', self.datastorage.put_data, data)
+
+    def flush(self):
+        '''
+        Decode and store the collected batch of responses.
+        '''
+
+        if not self.batch:
+            return
+        inserts = self.timed('decode', aggregator.decode_statuses, self.batch, self.content_types,
+                             self.unitindex)
+        self.timed('store', self.datastorage.put_many, inserts)
+        self.batch = []
+        self.content_types = []
+
+    def post(self):
+        '''
+        Analyze the data storage and make the results like the AnalyzerPoster does.
+        '''
+
+        self.flush()
+        totals = self.timed('analyze', self.datastorage.analyze, time.time(), self.unit_timeout,
+                            self.minimumsoc, self.maximumsoc)
+        self.results = self.timed('results', lambda: json.dumps(aggregator.make_results(totals)))
+
+if __name__ == '__main__':
+    # Set up the arguments.
+    parser = argparse.ArgumentParser(description='Replays captured aggregator traffic')
+    parser.add_argument('capture', help='The capture file')
+    parser.add_argument('--config', help='The aggregator configuration file for the SoC limits, the results '
+                        'interval, the unit timeout and the storage mode. Default aggregator.ini',
+                        default='aggregator.ini')
+    parser.add_argument('--speed', help='Replay speed relative to the recorded pace. 0 is as fast as possible. '
+                        'Default 0', default='0')
+    parser.add_argument('--storage', help='Storage mode. Default from the configuration file',
+                        choices=['dict', 'columnar', 'incremental'])
+    parser.add_argument('--batchsize', help='Responses stored at once. 1 stores them one by one. Default 500',
+                        default='500')
+    parser.add_argument('--output', help='File where the results are written. Default replay.json',
+                        default='replay.json')
+    parser.add_argument('--compare', help='An earlier results file to compare the results with.')
+    args = parser.parse_args()
+
+    # Read the analysis settings from the aggregator configuration.
+    config = ConfigParser.ConfigParser()
+    config.read(args.config)
+    minimumsoc = float(config.get('Units', 'minimumsoc'))
+    maximumsoc = float(config.get('Units', 'maximumsoc'))
+    resultsinterval = float(config.get('Results', 'resultsinterval'))
+    unittimeout = float(config.get('Results', 'unittimeout'))
+    storagemode = args.storage
+    if storagemode is None:
+        storagemode = 'dict'
+        if config.has_option('Storage', 'mode'):
+            storagemode = config.get('Storage', 'mode')
+
+    datastorage = aggregator.make_storage(storagemode, minimumsoc, maximumsoc)
+    replay = Replay(datastorage, int(args.batchsize), resultsinterval, unittimeout, minimumsoc, maximumsoc)
+    elapsed, captured = replay.run(aggregator.read_capture(args.capture), float(args.speed))
+
+    # The measured values for the output file.
+    results = {'responses': replay.responses,
+               'rounds': replay.rounds,
+               'captured_s': captured,
+               'elapsed_s': elapsed,
+               'responses_s': replay.responses/elapsed if elapsed > 0 else None}
+    for stage, title in STAGES:
+        total, calls = replay.timings[stage]
+        results[stage+'_ms'] = total*1000.0
+        results[stage+'_calls'] = calls
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as compare:
+            previous = json.load(compare)['results']
+
+    print "Replayed %d responses and %d poll rounds of %.1f s of traffic in %.1f s" % (
+        replay.responses, replay.rounds, captured, elapsed)
+    print "Throughput: %s responses/s%s" % (format_value(results['responses_s']),
+                                             " was %s" % format_value(previous['responses_s'])
+                                             if previous else '')
+    print "%-28s%10s%12s%12s%10s" % ('stage', 'calls', 'total ms', 'mean us', 'change')
+    for stage, title in STAGES:
+        total, calls = replay.timings[stage]
+        change = format_change(previous.get(stage+'_ms'), results[stage+'_ms']) if previous else '-'
+        print "%-28s%10d%12s%12s%10s" % (title, calls, format_value(total*1000.0),
+                                         format_value(total*1000000.0/calls if calls else None), change)
+
+    # Write the results with the parameters so runs can be compared.
+    parameters = {'capture': args.capture, 'speed': float(args.speed), 'storage': storagemode,
+                  'batchsize': int(args.batchsize), 'resultsinterval': resultsinterval}
+    with open(args.output, 'w') as output:
+        json.dump({'time': time.time(), 'parameters': parameters, 'results': results}, output, indent=2)
+    print "Results written to "+args.output
@@ -2,7 +2,8 @@
 test.py
 
 A simple test system to test that the aggregator.py is working.
-Creates 'Unit' thread for each simulated unit.
+Creates 'Unit' thread for each simulated unit or one 'VirtualFleet' thread that
+simulates all of them.
 
 The unit information comes from aggregator.ini.
 
@@ -13,6 +14,15 @@ Commandline parameters:
   --nonresponding NONRESPONDING
                         Percentage of non-active that are non-responding.
                         Default 0
+  --config CONFIG       The aggregator configuration file. Default aggregator.ini
+  --virtual             Simulate the units with one thread instead of a thread per unit.
+  --latency LATENCY     Mean response latency of the virtual units in seconds. Default 0
+  --distribution {constant,uniform,exponential,lognormal}
+                        Latency distribution of the virtual units. Default constant
+  --droprate DROPRATE   Probability that a virtual unit does not respond to a query.
+                        Default 0
+  --drift DRIFT         Standard deviation of the SoC change of the virtual units in one
+                        second. Default 0
 
 Copyright 2017 Janne Valtanen
 '''
@@ -23,6 +33,11 @@ import argparse
 import ConfigParser
 import json
 import random
+import heapq
+import math
+import time
+
+import aggregator
 
 class Unit(threading.Thread):
     '''
@@ -34,14 +49,17 @@ class Unit(threading.Thread):
     - active: Boolean telling if this unit is active or not.
     - soc: The SoC value.
     - totalcapacity: Total capacity in kWh.
+    - shards: The number of shards the aggregator uses in the 'sharded' scatter mode.
     '''
 
-    def __init__(self, unitid, hostname, active, soc, totalcapacity):
+    def __init__(self, unitid, hostname, active, soc, totalcapacity, shards=1):
         super(Unit, self).__init__()
         self.unitid = unitid
         self.active = active
         self.soc = soc
         self.totalcapacity = totalcapacity
+        # The index for the binary responses. Learned from the queries.
+        self.index = None
         print "-----------------------------"
         print "Starting test unit: "+self.unitid
         print "Active: "+str(self.active)
@@ -50,7 +68,7 @@ class Unit(threading.Thread):
         print "Opening RabbitMQ connection, hostname: "+hostname
     
         # Setup the MQTT connection and declare 'units' and 'states'
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(hostname))
+        self.connection = aggregator.open_connection(hostname)
         self.channel = self.connection.channel()
         self.channel.exchange_declare(exchange='units', type='direct')
         self.channel.queue_declare(queue='states', durable=False)
@@ -58,6 +76,10 @@ class Unit(threading.Thread):
         result = self.channel.queue_declare(exclusive=True)
         self.queue_name = result.method.queue
         self.channel.queue_bind(exchange='units', queue=self.queue_name, routing_key=self.unitid)
+        # Listen also to the broadcast and shard queries.
+        self.channel.queue_bind(exchange='units', queue=self.queue_name, routing_key=aggregator.BROADCAST_KEY)
+        self.channel.queue_bind(exchange='units', queue=self.queue_name,
+                                routing_key=aggregator.shard_key(self.unitid, shards))
         self.channel.basic_consume(self.status_callback_gen(), queue=self.queue_name, no_ack=True, 
                                    consumer_tag=self.unitid)
 
@@ -80,12 +102,28 @@ class Unit(threading.Thread):
             aggregator.
             '''
 
+            # Respond to the queue given in the query with the correlation ID of the query.
+            reply_to = properties.reply_to or 'states'
+            headers = properties.headers or {}
+            correlation_id = properties.correlation_id
+
+            # Respond in the binary format if the aggregator accepts it.
+            if headers.get('Accept') == aggregator.STATUS_CONTENT_TYPE:
+                unit.index = headers.get('UnitIndex', unit.index)
+                body = aggregator.encode_status(unit.unitid, unit.index, unit.active, unit.soc, unit.totalcapacity)
+                unit.channel.basic_publish(exchange='', routing_key=reply_to, body=body,
+                                           properties=pika.BasicProperties(
+                                               content_type=aggregator.STATUS_CONTENT_TYPE,
+                                               correlation_id=correlation_id))
+                return
+
             # Store to JSON and publish.
             jsondata = json.dumps({'UnitId': unit.unitid,
                                    'Active': unit.active,
                                    'SoC': unit.soc,
                                    'TotalCapacity': unit.totalcapacity})
-            unit.channel.basic_publish(exchange='', routing_key='states', body=jsondata)
+            unit.channel.basic_publish(exchange='', routing_key=reply_to, body=jsondata,
+                                       properties=pika.BasicProperties(correlation_id=correlation_id))
 
         return status_callback
 
@@ -104,9 +142,191 @@ class Unit(threading.Thread):
         print "Killing unit: "+self.unitid
         self.channel.stop_consuming()
 
+class VirtualUnit:
+    '''
+    The state of one unit simulated by the VirtualFleet.
+    '''
+
+    def __init__(self, unitid, active, soc, totalcapacity):
+        self.unitid = unitid
+        self.active = active
+        self.soc = soc
+        self.totalcapacity = totalcapacity
+        self.index = None
+        # The time of the previous response.
+        self.updated = None
+
+class VirtualFleet(threading.Thread):
+    '''
+    VirtualFleet thread class that simulates a large number of units with one thread and
+    one connection. The responses are sent from a heap ordered by the time they are due
+    so no thread is needed per unit.
+
+    Parameters:
+    - hostname: The hostname for the MQTT server
+    - units: A list of VirtualUnit instances.
+    - shards: The number of shards the aggregator uses in the 'sharded' scatter mode.
+    - latency: The mean response latency in seconds.
+    - distribution: The latency distribution. 'constant', 'uniform', 'exponential'
+                    or 'lognormal'.
+    - droprate: The probability that a unit does not respond to a query.
+    - drift: The standard deviation of the SoC change in one second.
+    - seed: The random seed. None seeds from the system.
+    '''
+
+    def __init__(self, hostname, units, shards=1, latency=0.0, distribution='constant', droprate=0.0,
+                 drift=0.0, seed=None):
+        super(VirtualFleet, self).__init__()
+        self.units = dict((unit.unitid, unit) for unit in units)
+        self.latency = latency
+        self.distribution = distribution
+        self.droprate = droprate
+        self.drift = drift
+        self.random = random.Random(seed)
+
+        # The units that get the queries of each shard.
+        self.shards = {}
+        for unit in units:
+            self.shards.setdefault(aggregator.shard_key(unit.unitid, shards), []).append(unit)
+
+        # The responses waiting to be sent as (due time, sequence, unit, reply_to, binary, correlation ID).
+        self.pending = []
+        self.sequence = 0
+        self.sent = 0
+        self.dropped = 0
+        print "Starting virtual fleet of "+str(len(units))+" units"
+        print "Opening RabbitMQ connection, hostname: "+hostname
+
+        # Setup the MQTT connection and declare 'units' and 'states'
+        self.connection = aggregator.open_connection(hostname)
+        self.channel = self.connection.channel()
+        self.channel.exchange_declare(exchange='units', type='direct')
+        self.channel.queue_declare(queue='states', durable=False)
+
+        # One queue for the whole fleet bound with the keys of every unit and shard.
+        result = self.channel.queue_declare(exclusive=True)
+        self.queue_name = result.method.queue
+        for routing_key in self.units.keys() + self.shards.keys() + [aggregator.BROADCAST_KEY]:
+            self.channel.queue_bind(exchange='units', queue=self.queue_name, routing_key=routing_key)
+        self.channel.basic_consume(self.query_callback, queue=self.queue_name, no_ack=True)
+
+        # Start the thread.
+        self.start()
+
+    def sample_latency(self):
+        '''
+        Draw one response latency from the configured distribution.
+
+        Returns: The latency in seconds.
+        '''
+
+        if self.latency <= 0:
+            return 0.0
+        if self.distribution == 'uniform':
+            return self.random.uniform(0, 2*self.latency)
+        if self.distribution == 'exponential':
+            return self.random.expovariate(1.0/self.latency)
+        if self.distribution == 'lognormal':
+            # Sigma 1 with the mean kept at the configured latency.
+            return self.random.lognormvariate(math.log(self.latency) - 0.5, 1.0)
+        return self.latency
+
+    def query_callback(self, ch, method, properties, body):
+        '''
+        The callback for status query messages for the 'units' exchange. Schedules the
+        responses of the queried units.
+        '''
+
+        # Find the units the query is for.
+        routing_key = method.routing_key
+        if routing_key == aggregator.BROADCAST_KEY:
+            units = self.units.itervalues()
+        elif routing_key in self.shards:
+            units = self.shards[routing_key]
+        else:
+            units = [self.units[routing_key]]
+
+        # Respond to the queue and in the format given in the query.
+        reply_to = properties.reply_to or 'states'
+        headers = properties.headers or {}
+        binary = headers.get('Accept') == aggregator.STATUS_CONTENT_TYPE
+        index = headers.get('UnitIndex')
+        correlation_id = properties.correlation_id
+
+        now = time.time()
+        for unit in units:
+            if index is not None:
+                unit.index = index
+            if self.droprate and self.random.random() < self.droprate:
+                self.dropped += 1
+                continue
+            self.sequence += 1
+            heapq.heappush(self.pending, (now + self.sample_latency(), self.sequence, unit, reply_to, binary,
+                                          correlation_id))
+
+    def respond(self, unit, reply_to, binary, correlation_id=None):
+        '''
+        Send the response of one unit. The SoC of an active unit drifts as a random walk
+        so the change since the previous response grows with the time between them.
+        '''
+
+        now = time.time()
+        if unit.active and self.drift and unit.updated is not None:
+            change = self.random.gauss(0, self.drift*math.sqrt(now - unit.updated))
+            unit.soc = min(1.0, max(0.0, unit.soc + change))
+        unit.updated = now
+
+        if binary:
+            body = aggregator.encode_status(unit.unitid, unit.index, unit.active, unit.soc, unit.totalcapacity)
+            self.channel.basic_publish(exchange='', routing_key=reply_to, body=body,
+                                       properties=pika.BasicProperties(
+                                           content_type=aggregator.STATUS_CONTENT_TYPE,
+                                           correlation_id=correlation_id))
+        else:
+            jsondata = json.dumps({'UnitId': unit.unitid,
+                                   'Active': unit.active,
+                                   'SoC': unit.soc,
+                                   'TotalCapacity': unit.totalcapacity})
+            self.channel.basic_publish(exchange='', routing_key=reply_to, body=jsondata,
+                                       properties=pika.BasicProperties(correlation_id=correlation_id))
+        self.sent += 1
+
+    def run(self):
+        '''
+        The run method of the thread. Consume the queries and send the responses when
+        they are due until killed.
+        '''
+
+        while self.channel._consumer_infos:
+            # Wake up in time for the next response.
+            time_limit = 1
+            if self.pending:
+                time_limit = min(1, max(0, self.pending[0][0] - time.time()))
+            self.channel.connection.process_data_events(time_limit=time_limit)
+
+            now = time.time()
+            while self.pending and self.pending[0][0] <= now:
+                due, sequence, unit, reply_to, binary, correlation_id = heapq.heappop(self.pending)
+                self.respond(unit, reply_to, binary, correlation_id)
+        print "Virtual fleet killed."
+
+    def kill(self):
+        '''
+        A method to kill the thread.
+        '''
+        print "Killing virtual fleet"
+        self.channel.stop_consuming()
+
+# Rebuilds the full results from the delta and compressed results messages.
+result_decoder = aggregator.ResultDecoder()
+
 def result_callback(ch, method, properties, body):
     # Results callback that will just display the results on the console.
-    print "Got results from aggerator: "+body
+    results = result_decoder.decode(body, properties)
+    if results is None:
+        print "Got results delta from aggregator before a keyframe. Waiting for the next keyframe."
+        return
+    print "Got results from aggerator: "+json.dumps(results)
 
 if __name__ == '__main__':
     # Set up the arguments.
@@ -115,17 +335,32 @@ if __name__ == '__main__':
     parser.add_argument('--oob', help='Percentage out of bound units from active. Default 0', default="0")
     parser.add_argument('--nonresponding', help='Percentage of non-active that are non-responding. Default 0', 
                         default="0")
+    parser.add_argument('--config', help='The aggregator configuration file. Default aggregator.ini',
+                        default='aggregator.ini')
+    parser.add_argument('--virtual', help='Simulate the units with one thread instead of a thread per unit.',
+                        action='store_true')
+    parser.add_argument('--latency', help='Mean response latency of the virtual units in seconds. Default 0',
+                        default="0")
+    parser.add_argument('--distribution', help='Latency distribution of the virtual units. Default constant',
+                        choices=['constant', 'uniform', 'exponential', 'lognormal'], default='constant')
+    parser.add_argument('--droprate', help='Probability that a virtual unit does not respond to a query. Default 0',
+                        default="0")
+    parser.add_argument('--drift', help='Standard deviation of the SoC change of the virtual units in one '
+                        'second. Default 0', default="0")
 
     args = parser.parse_args()
 
     # Read the node information from aggregator.ini file.
     config = ConfigParser.ConfigParser()
-    config.read('aggregator.ini')
+    config.read(args.config)
     hostname = config.get('Connection','hostname')
 
-    # Check that we can read everything.
+    # Check that we can read everything. The units come from the unit file if there is one.
     try:
-        unitids = json.loads(config.get('Units','unitids'))
+        if config.has_option('Units', 'unitfile'):
+            unitids = aggregator.load_unit_file(config.get('Units', 'unitfile'))
+        else:
+            unitids = json.loads(config.get('Units','unitids'))
     except Exception as e:
         print "Could not parse unit ID list: "+str(e)
         exit(1)
@@ -142,6 +377,14 @@ if __name__ == '__main__':
         print "Could not parse maximum SoC: "+str(e)
         exit(1)
 
+    try:
+        shards = 1
+        if config.has_option('Units', 'shards'):
+            shards = int(config.get('Units', 'shards'))
+    except Exception as e:
+        print "Could not parse shard count: "+str(e)
+        exit(1)
+
         
     # Select the units based on fail rates from command line.
     active_percentage = float(args.active)
@@ -150,7 +393,9 @@ if __name__ == '__main__':
     oob_percentage = float(args.oob)
     out_of_bounds = active_unit_ids[0: int(round(len(active_unit_ids)*oob_percentage/100.0))]
 
-    inactive_unit_ids = filter(lambda x: x not in active_unit_ids, unitids)
+    # Sets for the membership checks so that large fleets are fast to set up.
+    active_set = set(active_unit_ids)
+    inactive_unit_ids = filter(lambda x: x not in active_set, unitids)
     responding_inactive_percentage = 100.0-float(args.nonresponding)
     responding_inactive_unit_ids = \
         inactive_unit_ids[0: int(round(len(inactive_unit_ids)*responding_inactive_percentage/100.0))]    
@@ -161,29 +406,39 @@ if __name__ == '__main__':
     print 'Responding inactive units: '+'. '.join(responding_inactive_unit_ids)
 
     # Set up the test units.
-    units = []
+    out_of_bounds = set(out_of_bounds)
+    responding_inactive_unit_ids = set(responding_inactive_unit_ids)
+    virtualunits = []
     # Active units.
     for unitid in active_unit_ids:
         # Inside bounds.
         if unitid not in out_of_bounds:
             soc = random.uniform(minimumsoc, maximumsoc)
-            units.append(Unit(unitid, hostname, True, soc, [1000,2000,3000][random.randint(0,2)]))
+            virtualunits.append(VirtualUnit(unitid, True, soc, [1000,2000,3000][random.randint(0,2)]))
         # Out of bounds.
         else:
             soc = random.uniform(0, minimumsoc + 1-maximumsoc)
             if soc > minimumsoc:
                 soc += maximumsoc-minimumsoc
-            units.append(Unit(unitid, hostname, True, soc, [1000,2000,3000][random.randint(0,2)]))
+            virtualunits.append(VirtualUnit(unitid, True, soc, [1000,2000,3000][random.randint(0,2)]))
 
     # Inactive units.
     for unitid in inactive_unit_ids:
         # If the unit is inactive but responsive create the instance.
         if unitid in responding_inactive_unit_ids:
-            units.append(Unit(unitid, hostname, False, 0, [1000,2000,3000][random.randint(0,2)]))
+            virtualunits.append(VirtualUnit(unitid, False, 0, [1000,2000,3000][random.randint(0,2)]))
+
+    # Either one thread for all the units or a thread for each unit.
+    if args.virtual:
+        units = [VirtualFleet(hostname, virtualunits, shards, float(args.latency), args.distribution,
+                              float(args.droprate), float(args.drift))]
+    else:
+        units = [Unit(unit.unitid, hostname, unit.active, unit.soc, unit.totalcapacity, shards)
+                 for unit in virtualunits]
 
     # Set up the MQTT connection for the results gathering.
     print "Opening RabbitMQ connection, hostname: "+hostname
-    connection = pika.BlockingConnection(pika.ConnectionParameters(hostname))
+    connection = aggregator.open_connection(hostname)
     channel = connection.channel()
 
     channel.exchange_declare(exchange='result', type='fanout')
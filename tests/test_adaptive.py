@@ -0,0 +1,83 @@
+'''
+test_adaptive.py
+
+Tests for the poll intervals of the adaptive scatter mode.
+
+Copyright 2017 Janne Valtanen
+'''
+
+import unittest
+
+import aggregator
+
+# The base, shortest and longest poll interval and the SoC limits.
+POLLINTERVAL = 10.0
+MINIMUM = 1.0
+MAXIMUM = 60.0
+MINIMUMSOC = 0.1
+MAXIMUMSOC = 0.9
+
+class LatestStorage:
+    '''
+    A data storage that only has the latest responses of the units.
+    '''
+
+    def __init__(self):
+        # (ReceivedTime, Active, SoC) by unit ID.
+        self.latest = {}
+
+    def get_latest(self, unitids):
+        return dict((unitid, self.latest[unitid]) for unitid in unitids if unitid in self.latest)
+
+class AdaptivePollingTest(unittest.TestCase):
+    '''
+    Tests that the poll interval of a unit follows the rate of change of its SoC.
+    '''
+
+    def setUp(self):
+        self.adaptive = aggregator.AdaptivePolling(['Stable', 'Changing'], POLLINTERVAL, MINIMUM, MAXIMUM,
+                                                   MINIMUMSOC, MAXIMUMSOC)
+
+    def poll(self, until, soc):
+        '''
+        Poll the due units every half a second. The units respond right away.
+
+        Parameters:
+        - until: The time when the polling stops.
+        - soc: A function of the unit ID and the time that gives the SoC of the unit.
+
+        Returns: The latest poll interval by unit ID.
+        '''
+
+        storage = LatestStorage()
+        intervals = {}
+        now = 0.0
+        while now < until:
+            for unitid in self.adaptive.due_units(now, storage):
+                intervals[unitid] = self.adaptive.scheduled[unitid] - now
+                storage.latest[unitid] = (now, True, soc(unitid, now))
+            now += 0.5
+        return intervals
+
+    def test_stable_units_back_off(self):
+        intervals = self.poll(300.0, lambda unitid, now: 0.5)
+        self.assertEqual(intervals, {'Stable': MAXIMUM, 'Changing': MAXIMUM})
+
+    def test_changing_unit_is_polled_often_again(self):
+        self.poll(300.0, lambda unitid, now: 0.5)
+
+        # The SoC starts to fall 0.02 per second. Half of the distance to the minimum SoC
+        # is covered in less than the base interval.
+        intervals = [self.adaptive.update('Changing', (300.0 + second, True, 0.5 - 0.02*second))
+                     for second in xrange(4)]
+        self.assertEqual(intervals[0], MAXIMUM)
+        self.assertTrue(intervals[-1] <= POLLINTERVAL, intervals)
+        self.assertTrue(intervals[-1] > MINIMUM, intervals)
+
+        # Out of bounds units are polled at the shortest interval and the inactive ones
+        # at the base interval.
+        self.assertEqual(self.adaptive.update('Changing', (304.0, True, 0.05)), MINIMUM)
+        self.assertEqual(self.adaptive.update('Changing', (305.0, False, 0.05)), POLLINTERVAL)
+
+if __name__ == '__main__':
+    unittest.main()
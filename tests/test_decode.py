@@ -0,0 +1,66 @@
+'''
+test_decode.py
+
+Tests for decoding the status messages.
+
+Copyright 2017 Janne Valtanen
+'''
+
+import json
+import sys
+import unittest
+
+import aggregator
+
+class NullOutput:
+    '''
+    A file like object that throws away everything written to it.
+    '''
+
+    def write(self, text):
+        pass
+
+class DecodeStatusesTest(unittest.TestCase):
+    '''
+    Tests for decode_statuses().
+    '''
+
+    def setUp(self):
+        # The invalid messages are printed.
+        self.stdout = sys.stdout
+        sys.stdout = NullOutput()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def test_correlation_ids(self):
+        bodies = [json.dumps({'UnitId': 'U%d' % i, 'Active': True, 'SoC': 0.5, 'TotalCapacity': 1000})
+                  for i in xrange(3)]
+        inserts = aggregator.decode_statuses(bodies, correlation_ids=['a', 'b', 'c'])
+        self.assertEqual([(data['UnitId'], data['CorrelationId']) for data in inserts],
+                         [('U0', 'a'), ('U1', 'b'), ('U2', 'c')])
+
+    def test_body_with_many_objects(self):
+        # A body with two objects is invalid and does not shift the correlation IDs of the others.
+        bodies = ['{"UnitId": "A"}', '{"UnitId": "B"},{"UnitId": "C"}', '{"UnitId": "D"}']
+        inserts = aggregator.decode_statuses(bodies, correlation_ids=['a', 'b', 'd'])
+        self.assertEqual([(data['UnitId'], data['CorrelationId']) for data in inserts],
+                         [('A', 'a'), ('D', 'd')])
+
+    def test_body_that_is_not_an_object(self):
+        bodies = ['{"UnitId": "A"}', '[{"UnitId": "B"}]', '{"UnitId": "C"}']
+        inserts = aggregator.decode_statuses(bodies, correlation_ids=['a', 'b', 'c'])
+        self.assertEqual([(data['UnitId'], data['CorrelationId']) for data in inserts],
+                         [('A', 'a'), ('C', 'c')])
+
+    def test_binary_and_json(self):
+        unitindex = aggregator.UnitIndex(['U0', 'U1'])
+        bodies = [aggregator.encode_status('U0', 0, True, 0.25, 1000.0),
+                  json.dumps({'UnitId': 'U1', 'Active': False, 'SoC': 0.5, 'TotalCapacity': 2000})]
+        content_types = [aggregator.STATUS_CONTENT_TYPE, 'application/json']
+        inserts = aggregator.decode_statuses(bodies, content_types, unitindex, ['a', 'b'])
+        self.assertEqual(sorted((data['UnitId'], data['CorrelationId'], data['SoC']) for data in inserts),
+                         [('U0', 'a', 0.25), ('U1', 'b', 0.5)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+'''
+test_history.py
+
+Tests for the history of the responses.
+
+Copyright 2017 Janne Valtanen
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import aggregator
+
+class NullOutput:
+    '''
+    A file like object that throws away everything written to it.
+    '''
+
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+class TickingClock:
+    '''
+    A replacement of the time module of the aggregator that advances a second every time
+    it is read.
+    '''
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        self.now += 1.0
+        return self.now
+
+@unittest.skipIf(aggregator.numpy is None, 'Needs numpy')
+class HistoryStorageTest(unittest.TestCase):
+    '''
+    Tests for the HistoryStorage and the HistoryStore.
+    '''
+
+    def setUp(self):
+        # The storages print the invalid data.
+        self.stdout = sys.stdout
+        sys.stdout = NullOutput()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'history.bin')
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.directory)
+
+    def check_storage(self, datastorage):
+        history = aggregator.HistoryStore(self.path, slots=4, capacity=8)
+        storage = aggregator.HistoryStorage(datastorage, history)
+        unicode_id = u'Yksikk\xf6'
+        storage.queries_started(['U0', 'U1', unicode_id])
+        storage.remove_units(['U1'])
+        accepted = storage.put_many([{'UnitId': 'U0', 'Active': True, 'SoC': 0.5, 'TotalCapacity': 1000},
+                                     {'UnitId': 'U1', 'Active': True, 'SoC': 0.6, 'TotalCapacity': 1000},
+                                     {'UnitId': 'U2', 'Active': True, 'SoC': 0.7, 'TotalCapacity': 1000},
+                                     {'UnitId': unicode_id, 'Active': True, 'SoC': 0.8, 'TotalCapacity': 1000},
+                                     {'UnitId': 'U0', 'Active': True, 'SoC': 'invalid'}])
+        self.assertEqual([insert['UnitId'] for insert in accepted], ['U0', unicode_id])
+
+        # The removed and unknown units get no rows.
+        self.assertEqual(int(history.count[0]), 2)
+        self.assertTrue(history.get_samples('U1') is None)
+        self.assertTrue(history.get_samples('U2') is None)
+
+        # The unicode unit ID is found both as unicode and in UTF-8, also after reopening.
+        for store in [history, aggregator.HistoryStore(self.path, readonly=True)]:
+            for unitid in [unicode_id, unicode_id.encode('utf-8')]:
+                samples = store.get_samples(unitid)
+                self.assertAlmostEqual(samples['SoC'].max(), 0.8, places=6)
+            series = store.query(0.0, 2e9, 2e9, [unicode_id])
+            self.assertEqual(series[0]['Samples'], 1)
+
+    def test_sample_time(self):
+        # The sample has the time when the response was received, not when the history was written.
+        history = aggregator.HistoryStore(self.path, slots=4, capacity=8)
+        storage = aggregator.HistoryStorage(aggregator.DataStorage(), history)
+        storage.queries_started(['U0'])
+        clock = TickingClock()
+        time = aggregator.time
+        aggregator.time = clock
+        try:
+            storage.put_many([{'UnitId': 'U0', 'Active': True, 'SoC': 0.5, 'TotalCapacity': 1000}])
+        finally:
+            aggregator.time = time
+        sample_time = history.get_samples('U0')['Time'].max()
+        self.assertTrue(sample_time <= storage.get_all_data()['U0']['ReceivedTime'])
+        self.assertEqual(sample_time, 1001.0)
+
+    def test_dict_storage(self):
+        self.check_storage(aggregator.DataStorage())
+
+    def test_columnar_storage(self):
+        self.check_storage(aggregator.ColumnarDataStorage())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+'''
+test_ingest.py
+
+Tests for receiving the responses with the ingest buffer.
+
+Copyright 2017 Janne Valtanen
+'''
+
+import json
+import sys
+import unittest
+
+import aggregator
+
+class NullOutput:
+    '''
+    A file like object that throws away everything written to it.
+    '''
+
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+class IngestBufferTest(unittest.TestCase):
+    '''
+    Tests for acknowledging the messages of the Gatherer with the ingest buffer.
+    '''
+
+    def setUp(self):
+        # The Gatherer prints its progress.
+        self.stdout = sys.stdout
+        sys.stdout = NullOutput()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def start(self, name, capacity, policy):
+        '''
+        Start a Gatherer that is run from the test through a shared connection.
+
+        Returns: A tuple of the Gatherer, its data storage and a channel to publish with.
+        '''
+
+        hostname = aggregator.INPROCESS_SCHEME+name
+        storage = aggregator.DataStorage()
+        storage.queries_started(['U%d' % i for i in xrange(10)])
+        connection = aggregator.open_connection(hostname)
+        gatherer = aggregator.Gatherer(hostname, storage, batchdelay=60.0, connection=connection,
+                                       buffer=aggregator.IngestBuffer(capacity, policy))
+        return gatherer, storage, aggregator.open_connection(hostname).channel()
+
+    def publish(self, channel, gatherer, unitids):
+        '''
+        Publish a response of every unit and let the Gatherer receive them.
+        '''
+
+        for unitid in unitids:
+            channel.basic_publish(exchange='', routing_key='states',
+                                  body=json.dumps({'UnitId': unitid, 'Active': True, 'SoC': 0.5,
+                                                   'TotalCapacity': 1000}))
+        gatherer.connection.process_data_events(time_limit=0)
+
+    def stored(self, storage):
+        '''
+        Returns: The sorted IDs of the units whose responses have been stored.
+        '''
+
+        return sorted(unitid for unitid, unit in storage.get_all_data().iteritems() if unit)
+
+    def test_acknowledged_after_stored(self):
+        gatherer, storage, channel = self.start('ingest-flush', 4, 'flush')
+        self.publish(channel, gatherer, ['U0', 'U1', 'U2'])
+        gatherer.flush_if_due()
+        self.assertEqual(len(gatherer.channel.unacked), 3)
+        self.assertEqual(self.stored(storage), [])
+
+        # A full buffer is stored and then acknowledged.
+        self.publish(channel, gatherer, ['U3'])
+        self.assertEqual(len(gatherer.channel.unacked), 0)
+        self.assertEqual(self.stored(storage), ['U0', 'U1', 'U2', 'U3'])
+
+    def check_dropped(self, policy, kept):
+        # The prefetch is twice the capacity so two messages are dropped.
+        gatherer, storage, channel = self.start('ingest-'+policy, 2, policy)
+        self.publish(channel, gatherer, ['U0', 'U1', 'U2', 'U3'])
+        self.assertEqual(len(gatherer.channel.unacked), 2)
+        gatherer.flush()
+        self.assertEqual(len(gatherer.channel.unacked), 0)
+        self.assertEqual(self.stored(storage), kept)
+
+    def test_drop_newest(self):
+        self.check_dropped('drop-newest', ['U0', 'U1'])
+
+    def test_drop_oldest(self):
+        self.check_dropped('drop-oldest', ['U2', 'U3'])
+
+if __name__ == '__main__':
+    unittest.main()
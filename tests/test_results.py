@@ -0,0 +1,95 @@
+'''
+test_results.py
+
+Tests for encoding and decoding the results messages.
+
+Copyright 2017 Janne Valtanen
+'''
+
+import json
+import random
+import unittest
+
+import aggregator
+
+class ResultCodecTest(unittest.TestCase):
+    '''
+    Round trips of random results through the ResultEncoder and the ResultDecoder.
+    '''
+
+    def random_results(self, rand, unitids, count):
+        '''
+        Make a sequence of random results. The out of bounds units change a few at a time and
+        some values stay the same between the results.
+
+        Returns: A list of the results dictionaries.
+        '''
+
+        oob = set()
+        sequence = []
+        for i in xrange(count):
+            oob.symmetric_difference_update(rand.sample(unitids, rand.randint(0, 30)))
+            sequence.append({'AverageSoC': rand.choice([0.5, rand.random()]), 'RemainingCapacity': 3.0,
+                             'NumberOfActiveUnits': rand.randint(0, 3), 'NumberOfUnits': len(unitids),
+                             'UnitsOutOfBoundaries': list(oob), 'Metrics': {'Messages': i % 3}})
+        return sequence
+
+    def assertSameResults(self, decoded, results, message):
+        '''
+        Check that the decoded results are the same as the encoded ones. The order of the
+        out of bounds units is not kept.
+        '''
+
+        decoded = dict(decoded, UnitsOutOfBoundaries=sorted(decoded['UnitsOutOfBoundaries']))
+        results = dict(results, UnitsOutOfBoundaries=sorted(results['UnitsOutOfBoundaries']))
+        self.assertEqual(decoded, results, message)
+
+    def test_round_trip(self):
+        rand = random.Random(1)
+        unitids = ['U%d' % i for i in xrange(200)]
+        for delta in [False, True]:
+            for threshold in [0, 1, 500]:
+                encoder = aggregator.ResultEncoder(delta, 7, threshold)
+                decoder = aggregator.ResultDecoder()
+                late = aggregator.ResultDecoder()
+                for i, results in enumerate(self.random_results(rand, unitids, 100)):
+                    message = 'delta %s threshold %d message %d' % (delta, threshold, i)
+                    body, properties = encoder.encode(results)
+                    self.assertSameResults(decoder.decode(body, properties), results, message)
+
+                    # A subscriber that starts late and misses a message gets the results
+                    # again from the next keyframe on.
+                    if i < 3 or i == 23:
+                        continue
+                    decoded = late.decode(body, properties)
+                    if not delta or i % 7 == 0:
+                        self.assertTrue(decoded is not None, message)
+                    if decoded is not None:
+                        self.assertSameResults(decoded, results, message)
+
+    def test_unsequenced_then_delta(self):
+        # A publisher restarted in the delta mode whose keyframe is lost.
+        results = {'AverageSoC': 0.5, 'RemainingCapacity': 3.0, 'NumberOfActiveUnits': 1, 'NumberOfUnits': 2,
+                   'UnitsOutOfBoundaries': ['U1']}
+        decoder = aggregator.ResultDecoder()
+        body, properties = aggregator.ResultEncoder().encode(results)
+        self.assertSameResults(decoder.decode(body, properties), results, 'full')
+        encoder = aggregator.ResultEncoder(True, 10)
+        encoder.encode(results)
+        body, properties = encoder.encode(dict(results, AverageSoC=0.6))
+        self.assertTrue(decoder.decode(body, properties) is None)
+
+    def test_deleted_keys(self):
+        encoder = aggregator.ResultEncoder(True, 10)
+        decoder = aggregator.ResultDecoder()
+        results = {'AverageSoC': 0.5, 'RemainingCapacity': 3.0, 'NumberOfActiveUnits': 1, 'NumberOfUnits': 2,
+                   'UnitsOutOfBoundaries': ['U1'], 'Groups': {'Site': {}}}
+        # The last delta drops the keys that are no longer in the results.
+        sequence = [results, dict(results, AverageSoC=0.6), {'AverageSoC': 0.6, 'UnitsOutOfBoundaries': ['U1']}]
+        for message in sequence:
+            body, properties = encoder.encode(message)
+            self.assertSameResults(decoder.decode(body, properties), message, str(message))
+        self.assertTrue('Delta' in json.loads(body))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+'''
+test_rounds.py
+
+Tests for completing the poll rounds by their correlation IDs.
+
+Copyright 2017 Janne Valtanen
+'''
+
+import sys
+import unittest
+
+import aggregator
+from test_storage import Clock
+
+# The time a round waits for the replies.
+DEADLINE = 1.0
+
+class NullOutput:
+    '''
+    A file like object that throws away everything written to it.
+    '''
+
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+class RoundTrackerTest(unittest.TestCase):
+    '''
+    Tests for the RoundTracker with a fake clock and a Scheduler driven by run_due().
+    '''
+
+    def setUp(self):
+        self.clock = Clock()
+        self.time = aggregator.time
+        aggregator.time = self.clock
+        # The scheduler prints its progress.
+        self.stdout = sys.stdout
+        sys.stdout = NullOutput()
+        self.scheduler = aggregator.Scheduler(start=False)
+        # The time and the answered flag of every completed round.
+        self.completed = []
+        self.rounds = aggregator.RoundTracker(self.scheduler, DEADLINE,
+                                              lambda answered: self.completed.append((self.clock.now, answered)))
+
+    def tearDown(self):
+        aggregator.time = self.time
+        sys.stdout = self.stdout
+
+    def run_at(self, now):
+        '''
+        Fire the timers that are due at the given time.
+        '''
+
+        self.clock.now = now
+        self.scheduler.run_due()
+
+    def test_completes_when_every_unit_replied(self):
+        correlation_id = self.rounds.start_round(['U0', 'U1'])
+        self.clock.now = 0.2
+        self.rounds.replied([(correlation_id, 'U0'), ('old', 'U1')])
+        self.assertEqual(self.completed, [])
+
+        # The last reply completes the round before its deadline and the deadline does nothing.
+        self.clock.now = 0.3
+        self.rounds.replied([(correlation_id, 'U1')])
+        self.run_at(2.0)
+        self.assertEqual(self.completed, [(0.3, True)])
+
+    def test_completes_on_deadline(self):
+        self.clock.now = 10.0
+        correlation_id = self.rounds.start_round(['U0', 'U1'])
+        self.rounds.replied([(correlation_id, 'U0')])
+        self.run_at(10.5)
+        self.assertEqual(self.completed, [])
+        self.run_at(10.0 + DEADLINE)
+        self.assertEqual(self.completed, [(10.0 + DEADLINE, False)])
+
+        # The late replies do not complete the round again.
+        self.rounds.replied([(correlation_id, 'U1')])
+        self.assertEqual(len(self.completed), 1)
+
+    def test_next_round_completes_the_open_one(self):
+        first = self.rounds.start_round(['U0'])
+        self.clock.now = 0.5
+        second = self.rounds.start_round(['U0'])
+        self.assertNotEqual(first, second)
+        self.assertEqual(self.completed, [(0.5, False)])
+
+        # Only the deadline of the second round fires.
+        self.run_at(DEADLINE)
+        self.assertEqual(len(self.completed), 1)
+        self.run_at(0.5 + DEADLINE)
+        self.assertEqual(self.completed, [(0.5, False), (0.5 + DEADLINE, False)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+'''
+test_scheduler.py
+
+Tests for the Scheduler and its timers.
+
+Copyright 2017 Janne Valtanen
+'''
+
+import sys
+import unittest
+
+import aggregator
+from test_storage import Clock
+
+class NullOutput:
+    '''
+    A file like object that throws away everything written to it.
+    '''
+
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+class SchedulerTest(unittest.TestCase):
+    '''
+    Tests for the Scheduler driven by run_due() with a fake clock.
+    '''
+
+    def setUp(self):
+        self.clock = Clock()
+        self.time = aggregator.time
+        aggregator.time = self.clock
+        # The scheduler prints its progress.
+        self.stdout = sys.stdout
+        sys.stdout = NullOutput()
+        self.scheduler = aggregator.Scheduler(start=False)
+        self.fired = []
+
+    def tearDown(self):
+        aggregator.time = self.time
+        sys.stdout = self.stdout
+
+    def run_at(self, now):
+        '''
+        Fire the timers that are due at the given time.
+        '''
+
+        self.clock.now = now
+        self.scheduler.run_due()
+
+    def test_periodic_deadlines_stay_on_grid(self):
+        # The callback is slow so the clock has moved when it returns.
+        def callback(lateness):
+            self.fired.append((self.clock.now, lateness))
+            self.clock.now += 0.3
+        timer = self.scheduler.call_periodic(1.0, callback, first=10.0)
+
+        self.run_at(10.0)
+        self.assertEqual(timer.deadline, 11.0)
+
+        # A late tick is fired once and the missed ticks are skipped.
+        self.run_at(12.5)
+        self.assertEqual(self.fired[-1], (12.5, 1.5))
+        self.assertEqual(timer.deadline, 13.0)
+        self.assertEqual(timer.missed, 1)
+
+        # The next ticks are on the grid again.
+        self.run_at(13.0)
+        self.run_at(14.05)
+        self.assertEqual([round(now - lateness, 9) for now, lateness in self.fired], [10.0, 11.0, 13.0, 14.0])
+        self.assertEqual(timer.deadline, 15.0)
+        self.assertEqual(timer.ticks, 4)
+
+    def test_cancelled_timer_never_fires(self):
+        once = self.scheduler.call_at(5.0, lambda lateness: self.fired.append('once'))
+        periodic = self.scheduler.call_periodic(1.0, lambda lateness: self.fired.append('periodic'), first=1.0)
+        self.run_at(1.0)
+        self.scheduler.cancel(once)
+        self.scheduler.cancel(periodic)
+        for now in [2.0, 5.0, 10.0]:
+            self.run_at(now)
+        self.assertEqual(self.fired, ['periodic'])
+        self.assertTrue(self.scheduler.time_until_next() is None)
+
+if __name__ == '__main__':
+    unittest.main()
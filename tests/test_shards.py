@@ -0,0 +1,139 @@
+'''
+test_shards.py
+
+Tests for polling the units with many worker processes.
+
+Copyright 2017 Janne Valtanen
+'''
+
+import multiprocessing
+import Queue
+import sys
+import time
+import unittest
+
+import aggregator
+import test
+
+class NullOutput:
+    '''
+    A file like object that throws away everything written to it.
+    '''
+
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+def make_units(count):
+    '''
+    Make virtual units with fixed states. Every fifth unit is inactive.
+
+    Returns: A list of VirtualUnit instances.
+    '''
+
+    return [test.VirtualUnit('Unit%d' % i, i % 5 != 0, (i % 20)/20.0, 1000 + i) for i in xrange(count)]
+
+class FleetShardWorker(aggregator.ShardWorker):
+    '''
+    A ShardWorker that simulates the units of its shard in its own process. The in-process
+    broker of every process is separate so the units have to run in the worker process.
+    '''
+
+    def run(self):
+        fleet = test.VirtualFleet(self.hostname, [unit for unit in make_units(self.count)
+                                                  if unit.unitid in self.unitids])
+        aggregator.ShardWorker.run(self)
+        fleet.kill()
+
+def wait_for(analyze, count, timeout=10.0):
+    '''
+    Analyze until every unit has responded.
+
+    Returns: The totals.
+    '''
+
+    end = time.time() + timeout
+    while True:
+        totals = analyze()
+        if totals['NumberOfUnits'] == count and totals['NumberOfActiveUnits'] == count - count/5:
+            return totals
+        if time.time() > end:
+            return totals
+        time.sleep(0.1)
+
+class ShardMergerTest(unittest.TestCase):
+    '''
+    Tests for the ShardMerger and the ShardWorker processes.
+    '''
+
+    def setUp(self):
+        # The aggregator and the units print their progress.
+        self.stdout = sys.stdout
+        sys.stdout = NullOutput()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def test_stale_shard_is_left_out(self):
+        totals_queue = Queue.Queue()
+        merger = aggregator.ShardMerger(totals_queue, max_age=1.0)
+        first = {'NumberOfUnits': 2, 'NumberOfActiveUnits': 1, 'SoCSum': 0.5, 'RemainingCapacity': 500.0,
+                 'UnitsOutOfBoundaries': []}
+        second = {'NumberOfUnits': 3, 'NumberOfActiveUnits': 3, 'SoCSum': 1.5, 'RemainingCapacity': 1500.0,
+                  'UnitsOutOfBoundaries': ['U9']}
+        totals_queue.put((0, 100.0, first))
+        totals_queue.put((1, 98.5, second))
+        totals = merger.analyze(100.0, 1.0, 0.1, 0.9)
+        self.assertEqual(totals['NumberOfUnits'], 2)
+        self.assertEqual(totals['UnitsOutOfBoundaries'], [])
+
+        # The shard comes back when it sends its totals again.
+        totals_queue.put((1, 100.5, second))
+        totals = merger.analyze(101.0, 1.0, 0.1, 0.9)
+        self.assertEqual(totals['NumberOfUnits'], 5)
+        self.assertEqual(totals['UnitsOutOfBoundaries'], ['U9'])
+
+    def test_two_processes_match_one(self):
+        count = 60
+        unitids = [unit.unitid for unit in make_units(count)]
+
+        # The totals of one process.
+        hostname = aggregator.INPROCESS_SCHEME+'shards-single'
+        fleet = test.VirtualFleet(hostname, make_units(count))
+        datastorage = aggregator.make_storage('dict', 0.1, 0.9)
+        engine = aggregator.Engine(hostname, datastorage, unitids, 0.2, 'unicast', 1, 0, 1, 0.01, 0.2, 1.0,
+                                   0.1, 0.9)
+        try:
+            single = wait_for(lambda: datastorage.analyze(time.time(), 1.0, 0.1, 0.9), count)
+        finally:
+            engine.kill()
+            fleet.kill()
+
+        # The merged totals of two worker processes.
+        FleetShardWorker.count = count
+        totals_queue = multiprocessing.Queue()
+        hostname = aggregator.INPROCESS_SCHEME+'shards-multi'
+        workers = [FleetShardWorker(shard, hostname, [unitid for unitid in unitids
+                                                      if aggregator.shard_index(unitid, 2) == shard],
+                                    0.2, 'dict', 'unicast', 1, 0, 1, 0.01, 0.2, 1.0, 0.1, 0.9, totals_queue)
+                   for shard in range(2)]
+        merger = aggregator.ShardMerger(totals_queue, 0.4)
+        try:
+            merged = wait_for(lambda: merger.analyze(time.time(), 1.0, 0.1, 0.9), count)
+        finally:
+            for worker in workers:
+                worker.kill()
+            for worker in workers:
+                worker.join()
+
+        for key in ['NumberOfUnits', 'NumberOfActiveUnits']:
+            self.assertEqual(merged[key], single[key])
+        for key in ['SoCSum', 'RemainingCapacity']:
+            self.assertAlmostEqual(merged[key], single[key])
+        self.assertEqual(sorted(merged['UnitsOutOfBoundaries']), sorted(single['UnitsOutOfBoundaries']))
+        self.assertTrue(single['UnitsOutOfBoundaries'])
+
+if __name__ == '__main__':
+    unittest.main()
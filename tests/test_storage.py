@@ -0,0 +1,259 @@
+'''
+test_storage.py
+
+Tests for the data storages of the aggregator.
+
+Run with "python -m unittest discover -s tests" in the directory of aggregator.py.
+
+Copyright 2017 Janne Valtanen
+'''
+
+import copy
+import random
+import unittest
+
+import aggregator
+
+# The unit timeout and the SoC limits of the randomized tests.
+TIMEOUT = 5.0
+MINIMUMSOC = 0.2
+MAXIMUMSOC = 0.8
+
+class Clock:
+    '''
+    A replacement of the time module of the aggregator that gives the time of the test.
+    '''
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+class ReferenceStorage:
+    '''
+    The expected behaviour of the data storages written as simply as possible. A unit counts
+    with its latest response until its latest query has not been answered in the unit timeout
+    and then stays timed out until it responds again. A removed unit is forgotten and comes
+    back without a response when it is queried again.
+    '''
+
+    def __init__(self):
+        # The latest unanswered query time, the latest response and the timed out flag by unit ID.
+        self.units = {}
+        # The most units in the storage at once.
+        self.peak = 0
+
+    def time_out(self, current_time):
+        for unit in self.units.itervalues():
+            if unit['query'] is not None and current_time - unit['query'] > TIMEOUT:
+                unit['timed_out'] = True
+
+    def queries_started(self, unitids, current_time):
+        self.time_out(current_time)
+        for unitid in unitids:
+            unit = self.units.setdefault(unitid, {'query': None, 'response': None, 'timed_out': False})
+            unit['query'] = current_time
+        self.peak = max(self.peak, len(self.units))
+
+    def remove_units(self, unitids):
+        for unitid in unitids:
+            self.units.pop(unitid, None)
+
+    def put_many(self, inserts):
+        for insert in inserts:
+            unit = self.units.get(insert['UnitId'])
+            if unit is not None:
+                unit.update(query=None, response=insert, timed_out=False)
+
+    def analyze(self, current_time):
+        '''
+        Returns: The totals as a tuple that can be compared.
+        '''
+
+        self.time_out(current_time)
+        active = [unit['response'] for unit in self.units.itervalues()
+                  if unit['response'] is not None and not unit['timed_out'] and unit['response']['Active']]
+        return (len(self.units), len(active), round(sum(response['SoC'] for response in active), 6),
+                round(sum(response['SoC']*response['TotalCapacity'] for response in active), 3),
+                sorted(response['UnitId'] for response in active
+                       if not MINIMUMSOC <= response['SoC'] <= MAXIMUMSOC))
+
+    def get_all_data(self):
+        '''
+        Returns: The SoC of the latest response or None by unit ID.
+        '''
+
+        return dict((unitid, unit['response']['SoC'] if unit['response'] is not None else None)
+                    for unitid, unit in self.units.iteritems())
+
+def make_storages():
+    '''
+    Make every kind of data storage. The columnar storage starts small so that it grows.
+
+    Returns: A list of (name, storage) tuples.
+    '''
+
+    storages = [('dict', aggregator.DataStorage()),
+                ('incremental', aggregator.IncrementalDataStorage(MINIMUMSOC, MAXIMUMSOC))]
+    if aggregator.numpy is not None:
+        storages.append(('columnar', aggregator.ColumnarDataStorage(capacity=2)))
+    return storages
+
+class RandomizedStorageTest(unittest.TestCase):
+    '''
+    Compares the totals and the data of every data storage with the ReferenceStorage over
+    random queries, responses, removals and analyses. Checks also that the snapshots of the
+    storages do not change afterwards.
+    '''
+
+    def setUp(self):
+        self.clock = Clock()
+        self.time = aggregator.time
+        aggregator.time = self.clock
+
+    def tearDown(self):
+        aggregator.time = self.time
+
+    def run_random(self, seed):
+        '''
+        Run one random sequence and compare the totals at every analysis.
+        '''
+
+        rand = random.Random(seed)
+        unitids = ['U%d' % i for i in xrange(20)]
+        storages = make_storages()
+        reference = ReferenceStorage()
+        # The storages learn the unit timeout from the first analysis.
+        for name, storage in storages:
+            storage.analyze(self.clock.now, TIMEOUT, MINIMUMSOC, MAXIMUMSOC)
+        # The previous snapshot of every storage and its copy.
+        snapshots = {}
+        for tick in xrange(80):
+            self.clock.now = float(tick)
+            event = rand.random()
+            if event < 0.25:
+                # Query some units one by one or all at once.
+                queried = rand.sample(unitids, rand.randint(1, len(unitids)))
+                for name, storage in storages:
+                    if rand.random() < 0.5:
+                        storage.queries_started(queried)
+                    else:
+                        for unitid in queried:
+                            storage.query_started(unitid)
+                reference.queries_started(queried, self.clock.now)
+            elif event < 0.35:
+                # Remove some units. They may be queried again later.
+                removed = rand.sample(unitids, rand.randint(1, 5))
+                for name, storage in storages:
+                    storage.remove_units(removed)
+                reference.remove_units(removed)
+            elif event < 0.65:
+                # Responses from some units, also from the units that have not been queried.
+                inserts = [{'UnitId': unitid, 'Active': rand.random() < 0.9, 'SoC': round(rand.random(), 3),
+                            'TotalCapacity': rand.choice([1000, 2000])}
+                           for unitid in rand.sample(unitids, rand.randint(1, len(unitids)))]
+                for name, storage in storages:
+                    storage.put_many(inserts)
+                reference.put_many(inserts)
+            else:
+                expected = reference.analyze(self.clock.now)
+                for name, storage in storages:
+                    totals = storage.analyze(self.clock.now, TIMEOUT, MINIMUMSOC, MAXIMUMSOC)
+                    got = (totals['NumberOfUnits'], totals['NumberOfActiveUnits'], round(totals['SoCSum'], 6),
+                           round(totals['RemainingCapacity'], 3), sorted(totals['UnitsOutOfBoundaries']))
+                    self.assertEqual(got, expected, 'seed %d tick %d storage %s' % (seed, tick, name))
+                expected = reference.get_all_data()
+                for name, storage in storages:
+                    message = 'seed %d tick %d storage %s' % (seed, tick, name)
+                    if name in snapshots:
+                        self.check_snapshot(snapshots[name], message)
+                    snapshots[name] = self.take_snapshot(storage)
+                    data = storage.get_all_data()
+                    self.assertEqual(dict((unitid, unit.get('SoC')) for unitid, unit in data.iteritems()),
+                                     expected, message)
+                    if name == 'columnar':
+                        # The rows of the removed units are reused.
+                        self.assertTrue(len(snapshots[name][0][0]) <= reference.peak, message)
+
+    def take_snapshot(self, storage):
+        '''
+        Take a snapshot of the storage and copy it.
+
+        Returns: A tuple of the snapshot and its copy.
+        '''
+
+        if isinstance(storage, aggregator.ColumnarDataStorage):
+            snapshot = storage.get_columns()
+            return snapshot, (list(snapshot[0]), dict((name, column.copy())
+                                                      for name, column in snapshot[1].iteritems()))
+        snapshot = storage.get_all_data()
+        return snapshot, copy.deepcopy(snapshot)
+
+    def check_snapshot(self, snapshots, message):
+        '''
+        Check that a snapshot is still the same as its copy.
+        '''
+
+        snapshot, saved = snapshots
+        if isinstance(snapshot, tuple):
+            self.assertEqual(snapshot[0], saved[0], message)
+            self.assertEqual(sorted(snapshot[1]), sorted(saved[1]), message)
+            for name, column in saved[1].iteritems():
+                aggregator.numpy.testing.assert_array_equal(snapshot[1][name], column, message)
+        else:
+            self.assertEqual(snapshot, saved, message)
+
+    def test_queries_and_timeouts(self):
+        for seed in xrange(100):
+            self.run_random(seed)
+
+class DataStorageTest(unittest.TestCase):
+    '''
+    Tests for the DataStorage.
+    '''
+
+    def test_snapshot_is_not_changed(self):
+        # Take a snapshot with one response in it.
+        storage = aggregator.DataStorage()
+        storage.queries_started(['U0', 'U1'])
+        storage.put_data({'UnitId': 'U0', 'Active': True, 'SoC': 0.5, 'TotalCapacity': 1000})
+        data = storage.get_all_data()
+
+        # The writes after the snapshot are only in the next snapshot.
+        storage.put_data({'UnitId': 'U1', 'Active': True, 'SoC': 0.7, 'TotalCapacity': 1000})
+        storage.remove_units(['U0'])
+        storage.queries_started(['U2'])
+        self.assertEqual(sorted(data), ['U0', 'U1'])
+        self.assertEqual(data['U0']['SoC'], 0.5)
+        self.assertEqual(data['U1'], {})
+        latest = storage.get_all_data()
+        self.assertEqual(sorted(latest), ['U1', 'U2'])
+        self.assertEqual(latest['U1']['SoC'], 0.7)
+
+@unittest.skipIf(aggregator.numpy is None, 'Needs numpy')
+class ColumnarDataStorageTest(unittest.TestCase):
+    '''
+    Tests for the ColumnarDataStorage.
+    '''
+
+    def test_snapshot_after_growth(self):
+        # Fill the storage to its capacity and take a snapshot.
+        storage = aggregator.ColumnarDataStorage(capacity=4)
+        storage.queries_started(['U0', 'U1', 'U2', 'U3'])
+        unitids, columns = storage.get_columns()
+
+        # Growing the columns and removing a unit must not change the snapshot.
+        storage.queries_started(['U4'])
+        storage.remove_units(['U0'])
+        storage.queries_started(['U5'])
+        self.assertEqual(unitids, ['U0', 'U1', 'U2', 'U3'])
+        self.assertTrue(columns['Present'].all())
+
+        # The next snapshot has the reused row.
+        unitids, columns = storage.get_columns()
+        self.assertEqual(unitids, ['U5', 'U1', 'U2', 'U3', 'U4'])
+        self.assertTrue(columns['Present'].all())
+
+if __name__ == '__main__':
+    unittest.main()